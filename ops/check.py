@@ -1,14 +1,22 @@
 from collections import defaultdict
-import regex
+import os
 
-from sqlalchemy import distinct
+from sqlalchemy import func, text
 
 from ops.logger import setup_logging, output_to_loggers
+from ops.query_counter import assert_query_count, count_queries
 from ops.utils import get_date
 
 
 CONSOLE, CHECK = setup_logging("check")
 
+# upper bound of queries for check_db when PANELOPS_ASSERT_QUERIES is set
+MAX_CHECK_QUERIES = 12
+
+# boolean flags stored in the db (canonical and clinical transcript statuses)
+# to the booleans of the g2t file, anything else is unknown
+DB_FLAG_TO_BOOL = {0: False, 1: True}
+
 
 def check_db(
     files: dict, session, meta, panelapp_dict: dict, superpanel_dict: dict,
@@ -52,43 +60,68 @@ def check_db(
 
     error_detected = False
 
-    # check the clinical indications structure
-    ci_errors = check_clinical_indications(
-        session, ci2targets, panelapp_dict, superpanel_dict, ci_tb,
-        ci_panels_tb, panel_tb, panel_features_tb
+    # genes of the superpanels gathered once for both the clinical indication
+    # and the panel checks
+    superpanel_genes = get_superpanel_genes(panelapp_dict, superpanel_dict)
+
+    # run all the checks in one read only transaction so that they all see
+    # the same snapshot of the database. the transaction characteristics
+    # apply to the next transaction so end the current one first
+    session.rollback()
+    session.execute(
+        text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
     )
 
-    # check if errors in the clinical indications bit
-    for error in ci_errors:
-        error_detected = True
-        CHECK.error(error)
+    try:
+        # record the queries sent to the database by the checks
+        with count_queries(session) as statements:
+            # check the clinical indications structure
+            ci_errors = check_clinical_indications(
+                session, ci2targets, panelapp_dict, superpanel_genes, ci_tb,
+                ci_panels_tb, panel_tb, panel_features_tb
+            )
 
-    global_panel_errors, panel_errors = check_panels(
-        session, panelapp_dict, superpanel_dict, panel_type_tb,
-        panel_features_tb, panel_tb, feature_tb, gene_tb, feature_type_tb
-    )
+            global_panel_errors, panel_errors = check_panels(
+                session, panelapp_dict, superpanel_dict, superpanel_genes,
+                panel_type_tb, panel_features_tb, panel_tb, feature_tb,
+                gene_tb, feature_type_tb
+            )
+
+            g2t_errors = check_g2t(
+                session, gene_dict, g2t_data, gene_tb, g2t_tb, transcript_tb
+            )
+    finally:
+        # end the read only transaction
+        session.rollback()
+
+    CHECK.debug(f"{len(statements)} queries executed for the check")
+
+    # debug mode: the number of queries should not depend on the amount of
+    # data checked
+    if os.environ.get("PANELOPS_ASSERT_QUERIES"):
+        assert_query_count(statements, MAX_CHECK_QUERIES, CHECK, CONSOLE)
+
+    # gather all the errors to write them to the check log in one go rather
+    # than one record per error
+    errors_to_log = [str(error) for error in ci_errors]
 
     # check if errors in the total number of panels
     if global_panel_errors is not None:
-        error_detected = True
-        CHECK.error(global_panel_errors)
+        errors_to_log.append(global_panel_errors)
 
-    g2t_errors = check_g2t(
-        session, gene_dict, g2t_data, gene_tb, g2t_tb, transcript_tb
-    )
-
-    for error in g2t_errors:
-        error_detected = True
-        CHECK.error(error)
+    errors_to_log.extend(str(error) for error in g2t_errors)
 
     # check if errors in the individual panels
     for panelapp_id, logged_data in panel_errors.items():
         for error_type, errors in logged_data.items():
-            for error in errors:
-                error_detected = True
-                CHECK.error(
-                    f"Panelapp_id {panelapp_id}-{error_type}: {error}"
-                )
+            errors_to_log.extend(
+                f"Panelapp_id {panelapp_id}-{error_type}: {error}"
+                for error in errors
+            )
+
+    if errors_to_log:
+        error_detected = True
+        CHECK.error("\n".join(errors_to_log))
 
     # check if there's an error to raise the exception
     if error_detected is True:
@@ -106,8 +139,46 @@ def check_db(
     return True
 
 
+def get_superpanel_genes(panel_dict: dict, superpanel_dict: dict):
+    """ Gather the genes of the superpanels using their subpanels
+
+    Args:
+        panel_dict (dict): Dict with panel data from panelapp
+        superpanel_dict (dict): Dict with superpanel data from panelapp
+
+    Returns:
+        dict: Dict of superpanel ids to the set of genes of their subpanels
+    """
+
+    superpanel_genes = {}
+
+    for superpanel_id, superpanel_data in superpanel_dict.items():
+        # panel_dict is a defaultdict, check the subpanels are in it rather
+        # than indexing it to not add empty panels to the panelapp data
+        missing_subpanels = [
+            subpanel
+            for subpanel in superpanel_data["subpanels"]
+            if subpanel not in panel_dict
+        ]
+
+        if missing_subpanels:
+            CHECK.warning(
+                f"Subpanels of superpanel {superpanel_id} not present in the "
+                f"panelapp data: {missing_subpanels}"
+            )
+
+        # the genes of the panels are already sets so union them in one call
+        superpanel_genes[superpanel_id] = set().union(*(
+            panel_dict[subpanel]["genes"]
+            for subpanel in superpanel_data["subpanels"]
+            if subpanel in panel_dict
+        ))
+
+    return superpanel_genes
+
+
 def check_clinical_indications(
-    session, ci2targets: dict, panel_dict: dict, superpanel_dict: dict,
+    session, ci2targets: dict, panel_dict: dict, superpanel_genes: dict,
     ci_tb, ci_panels_tb, panel_tb, panel_feature_tb
 ):
     """ Check the structure of clinical indications in the database
@@ -116,7 +187,7 @@ def check_clinical_indications(
         session (SQLAlchemy.session): SQL Alchemy session
         ci2targets (dict): Dict with clinical indication data from test directory 
         panel_dict (dict): Dict with panel data from panelapp
-        superpanel_dict (dict): Dict with superpanel data from panelapp
+        superpanel_genes (dict): Dict of superpanel ids to their genes
         ci_tb: SQL Alchemy queryable table for clinical indication
         ci_panels_tb: SQL Alchemy queryable table for clinical indication panels
         panel_tb: SQL Alchemy queryable table for panels
@@ -128,23 +199,61 @@ def check_clinical_indications(
 
     log = []
 
-    db_ci = session.query(ci_tb).all()
+    # count the clinical indications server side rather than fetching every
+    # row just to get the length
+    nb_db_ci = session.query(func.count(ci_tb.c.id)).scalar()
 
     # check if the number of tests is the same between the excel and the
     # database
-    if len(ci2targets) != len(db_ci):
+    if len(ci2targets) != nb_db_ci:
         msg = (
             "Number of tests in the test directory and the database different"
-            f": {len(ci2targets)} (test) vs {len(db_ci)} (db)"
+            f": {len(ci2targets)} (test) vs {nb_db_ci} (db)"
         )
         log.append(msg)
 
+    # get the distinct features of every clinical indication in one query and
+    # group them using the clinical indication primary key
+    ci2features = defaultdict(set)
+
+    for ci_pk, feature_pk in session.query(
+        ci_panels_tb.c.clinical_indication_id, panel_feature_tb.c.feature_id
+    ).select_from(panel_feature_tb).join(
+        ci_panels_tb,
+        ci_panels_tb.c.panel_id == panel_feature_tb.c.panel_id
+    ).distinct().yield_per(1000):
+        ci2features[ci_pk].add(feature_pk)
+
+    # index the test codes using the clinical indication id i.e. R80 -> R80.1
+    # to find the tests of the hardcoded clinical indications without going
+    # through all the test codes
+    ci_id2test_codes = defaultdict(list)
+
+    for r_code in ci2targets:
+        ci_id2test_codes[r_code.split(".")[0]].append(r_code)
+
+    # get the panelapp ids linked to every clinical indication in one streamed
+    # query instead of one query per clinical indication
+    ci2panelapp_ids = defaultdict(list)
+
+    for ci_pk, panelapp_id in session.query(
+        ci_panels_tb.c.clinical_indication_id, panel_tb.c.panelapp_id
+    ).join(panel_tb).yield_per(1000):
+        ci2panelapp_ids[ci_pk].append(panelapp_id)
+
+    # no other query is made while going through the clinical indications so
+    # they can be streamed
+    db_ci = session.query(ci_tb).yield_per(1000)
+
     # loop through the rows in the database
     for ci_row in db_ci:
         ci_pk, ci_id, name, version, gemini_name = ci_row
 
+        # assign data of the clinical indication
+        data = ci2targets.get(ci_id)
+
         # check if the test_code is in the test directory data
-        if ci_id not in ci2targets:
+        if data is None:
             msg = (
                 f"Clinical indication {ci_id} doesn't exist in the "
                 "test directory"
@@ -152,38 +261,52 @@ def check_clinical_indications(
             log.append(msg)
             continue
 
-        # assign data of the clinical indication
-        data = ci2targets[ci_id]
+        # bind the targets of the clinical indication once, panels and genes
+        # are None if the clinical indication doesn't have any
+        tests = data["tests"]
+        panels = data.get("panels")
+        genes = data.get("genes")
 
-        # check the attributes for the test
+        # check the attributes for the test in one comparison
         if (
-            data["name"] != name or data["version"] != version or
-            data["gemini_name"] != gemini_name
+            (data["name"], data["version"], data["gemini_name"]) !=
+            (name, version, gemini_name)
         ):
             msg = (
                 "Discrepancy between data gathered from test directory and "
                 "stored detected please check the logs for more info"
             )
             log.append(msg)
-            log.append(data)
-            log.append(ci_row[1:])
+            # only log the compared attributes, the whole test directory data
+            # goes to the debug output
+            log.append(
+                f"{ci_id}: {data['name']}, {data['version']}, "
+                f"{data['gemini_name']} (test directory) vs {name}, "
+                f"{version}, {gemini_name} (db)"
+            )
+            CHECK.debug("Test directory data for %s: %s", ci_id, data)
+
+        # sets of the expected targets so that the membership checks on the
+        # links don't scan lists
+        expected_panels = frozenset(panels or ())
+        expected_genes = frozenset(genes or ())
 
         features = set()
-        hd_test_data = []
 
         # handle stupid hardcoded clinical indications that now point to
         # other clinical indications
-        if data["tests"] != []:
-            hd_tests = []
+        if tests:
             # gather panels for the now retired test using the panels for the
             # new tests
             hd_panels = set()
 
-            # find the specific test codes using the clinical indication id
-            for test in data["tests"]:
-                for r_code in ci2targets:
-                    if test in r_code:
-                        hd_tests.append(r_code)
+            # find the specific test codes using the clinical indication id,
+            # as a set so that a test code is only gathered once
+            hd_tests = {
+                r_code
+                for test in tests
+                for r_code in ci_id2test_codes.get(test, [])
+            }
 
             # go through those test codes to find genes and panels linked to
             # the tests to finally link back to the original clinical
@@ -202,35 +325,32 @@ def check_clinical_indications(
                         features.update(panel_dict[panel]["genes"])
         else:
             # normal test, check if it has single genes
-            if "genes" in data:
-                features.update(data["genes"])
+            if genes is not None:
+                features.update(genes)
 
             # normal test, check if it has panels
-            if "panels" in data:
-                for panel in data["panels"]:
+            if panels is not None:
+                for panel in panels:
                     # if the panel is a superpanel we want to get the genes
                     # from the subpanels associated to the superpanel and link
                     # it back to the superpanel
-                    if panel in superpanel_dict:
-                        for subpanel in superpanel_dict[panel]["subpanels"]:
-                            features.update(panel_dict[subpanel]["genes"])
+                    if panel in superpanel_genes:
+                        features.update(superpanel_genes[panel])
 
                     # normal panel, get all the genes for the panels associated
                     # with the test
                     else:
                         features.update(panel_dict[panel]["genes"])
 
-        # get all the panel ids from the clinical indication primary key
-        db_panels = session.query(panel_tb.c.id).join(ci_panels_tb).filter(
-            ci_panels_tb.c.clinical_indication_id == ci_pk
-        ).all()
+        # nothing expected and nothing stored for the clinical indication, no
+        # need to compare the features and links
+        if (
+            not features and ci_pk not in ci2features and
+            ci_pk not in ci2panelapp_ids
+        ):
+            continue
 
-        # get all the features using the previously acquired panel ids
-        db_features = session.query(
-            distinct(panel_feature_tb.c.feature_id)
-        ).filter(
-            panel_feature_tb.c.panel_id.in_(db_panels)
-        ).all()
+        db_features = ci2features.get(ci_pk, set())
 
         # check if the nb of features gathered for the clinical indication
         # is equal to the nb of features associated to the clinical indication
@@ -243,60 +363,57 @@ def check_clinical_indications(
             )
             log.append(msg)
 
-            if "panels" in data:
-                log.append("Genes in panels:")
-                log.append(features)
-
-            if "genes" in data:
-                log.append("Single genes")
-                log.append(data["genes"])
+            # the full gene and feature sets can be large, they go to the debug
+            # output and are only formatted there
+            if panels is not None:
+                CHECK.debug("Genes in panels of %s: %s", ci_id, features)
 
-            log.append("Links stored in the database")
-            log.append(db_features)
+            if genes is not None:
+                CHECK.debug("Single genes of %s: %s", ci_id, genes)
 
-        msg = (
-            f"{name}: Panelapp id not present in data gathered from the "
-            "test directory"
-        )
+            CHECK.debug(
+                "Features stored in the database for %s: %s", ci_id,
+                db_features
+            )
 
-        # get all the links from clinical indication to panels
-        db_ci_link = session.query(ci_panels_tb).filter(
-            ci_panels_tb.c.clinical_indication_id == ci_pk
-        ).all()
+        # links not found in the test directory data with the targets they
+        # were checked against, the messages are only built for those
+        missing_links = []
 
         # go through the clinical indication to panels links
-        for link_pk, ci_pk, panel_pk in db_ci_link:
-            # get the panelapp id of the link
-            panelapp_id = session.query(panel_tb.c.panelapp_id).filter(
-                panel_tb.c.id == panel_pk
-            ).one()[0]
-
-            # check whether it's a single gene panel or a normal panel
-            if regex.match(r"[0-9+]", panelapp_id):
+        for panelapp_id in ci2panelapp_ids[ci_pk]:
+            # check whether it's a single gene panel or a normal panel i.e.
+            # panelapp ids start with a digit, single gene panels with HGNC
+            if panelapp_id[:1].isdigit():
                 # its a panelapp id
                 # check if the clinical indication contains the panel
-                if data["tests"] != []:
+                if tests:
                     if panelapp_id not in hd_panels:
-                        log.append(msg)
-                        log.append(f"{panelapp_id} not in {data['panels']}")
+                        missing_links.append((panelapp_id, expected_panels))
 
-                elif panelapp_id not in data["panels"]:
-                    log.append(msg)
-                    log.append(f"{panelapp_id} not in {data['panels']}")
+                elif panelapp_id not in expected_panels:
+                    missing_links.append((panelapp_id, expected_panels))
             else:
                 # its a gene panel
                 # check if the clinical indication contains the single gene
                 # panel
-                if panelapp_id[:-3] not in data["genes"]:
-                    log.append(msg)
-                    log.append(f"{panelapp_id} not in {data['genes']}")
+                if panelapp_id[:-3] not in expected_genes:
+                    missing_links.append((panelapp_id, expected_genes))
+
+        for panelapp_id, expected_targets in missing_links:
+            log.append(
+                f"{name}: Panelapp id not present in data gathered from the "
+                "test directory"
+            )
+            log.append(f"{panelapp_id} not in {sorted(expected_targets)}")
 
     return log
 
 
 def check_panels(
-    session, panelapp_dict: dict, superpanel_dict: dict, panel_type_tb,
-    panel_features_tb, panel_tb, feature_tb, gene_tb, feature_type_tb
+    session, panelapp_dict: dict, superpanel_dict: dict,
+    superpanel_genes: dict, panel_type_tb, panel_features_tb, panel_tb,
+    feature_tb, gene_tb, feature_type_tb
 ):
     """ Check if the panel structure in the database is correct
 
@@ -304,6 +421,7 @@ def check_panels(
         session (SQL Alchemy session): SQL Alchemy session
         panelapp_dict (dict): Dict with panel data from panelapp
         superpanel_dict (dict): Dict with superpanel data from panelapp
+        superpanel_genes (dict): Dict of superpanel ids to their genes
         panel_type_tb: SQL Alchemy queryable table for panel type
         panel_features_tb: SQL Alchemy queryable table for panel to features
         panel_tb: SQL Alchemy queryable table for panels
@@ -311,64 +429,88 @@ def check_panels(
         gene_tb: SQL Alchemy queryable table for genes
         feature_type_tb: SQL Alchemy queryable table for feature types
 
-    Raises:
-        Exception: If the panelapp id is not in the panelapp data dump
-
     Returns:
         tuple: str, list for error at the total nb of panel, errors at the
                     panel level
     """
 
     nb_error = None
-    panel_log = defaultdict(lambda: defaultdict(list))
+    panel_log = {}
 
-    # get all panels stored in the db
-    db_panels = session.query(panel_tb).all()
+    # number of panels stored in the db, counted server side
+    nb_db_panels = session.query(func.count(panel_tb.c.id)).scalar()
     # number of regular panels (single gene panel included) + superpanels
     total_nb_panels = len(panelapp_dict) + len(superpanel_dict)
 
-    if total_nb_panels != len(db_panels):
+    if total_nb_panels != nb_db_panels:
         msg = (
             "Number of panels in the panelapp dump and the database different"
             f": {len(panelapp_dict)} (panel) + {len(superpanel_dict)} "
-            f"(superpanel) vs {len(db_panels)} (db)"
+            f"(superpanel) vs {nb_db_panels} (db)"
         )
         nb_error = msg
 
+    # get the panel types once rather than querying them for every panel
+    panel_types = dict(
+        session.query(panel_type_tb.c.id, panel_type_tb.c.type).all()
+    )
+
+    # get all the links to the feature table with the hgnc id and type of the
+    # features in one query and group them using the panel primary key,
+    # streaming the rows in batches instead of loading them all at once
+    panel2features = defaultdict(list)
+
+    for (
+        link_panel_pk, feature_pk, panel_version, hgnc_id, feature_type
+    ) in session.query(
+        panel_features_tb.c.panel_id, panel_features_tb.c.feature_id,
+        panel_features_tb.c.panel_version, gene_tb.c.hgnc_id,
+        feature_type_tb.c.type
+    ).join(
+        feature_tb, feature_tb.c.id == panel_features_tb.c.feature_id
+    ).outerjoin(gene_tb).outerjoin(feature_type_tb).yield_per(1000):
+        panel2features[link_panel_pk].append(
+            (feature_pk, panel_version, hgnc_id, feature_type)
+        )
+
+    # data and genes of every panel of the panelapp dump to get them with a
+    # single lookup for every stored panel, regular panels take precedence
+    panelapp_id2data = {
+        panelapp_id: (panel_data, superpanel_genes[panelapp_id])
+        for panelapp_id, panel_data in superpanel_dict.items()
+    }
+    panelapp_id2data.update({
+        panelapp_id: (panel_data, panel_data["genes"])
+        for panelapp_id, panel_data in panelapp_dict.items()
+    })
+
+    # get all panels stored in the db, streamed in batches as no other query
+    # is made while going through them
+    db_panels = session.query(
+        panel_tb.c.id, panel_tb.c.panelapp_id, panel_tb.c.name,
+        panel_tb.c.panel_type_id
+    ).yield_per(1000)
+
     # loop through stored panels
     for panel_row in db_panels:
         panel_pk, panelapp_id, name, panel_type_pk = panel_row
+        # bind the error list of the panel once instead of looking it up for
+        # every error
+        panel_entry = panel_log.setdefault(panelapp_id, {"errors": []})
+        errors = panel_entry["errors"]
+
+        dump_data = panelapp_id2data.get(panelapp_id)
 
         # if not in panelapp dict or superpanel dict --> panel imported is not
         # in panelapp anymore
-        if (
-            panelapp_id not in panelapp_dict and
-            panelapp_id not in superpanel_dict
-        ):
+        if dump_data is None:
             msg = (
                 f"Panel {panelapp_id} doesn't exist in the panelapp data"
             )
-            panel_log[panelapp_id]["errors"].append(msg)
+            errors.append(msg)
             continue
 
-        # check whether the db panel is a "regular" panel or a superpanel
-        if panelapp_id in panelapp_dict:
-            panel_data = panelapp_dict[panelapp_id]
-            hgnc_ids = panel_data["genes"]
-        elif panelapp_id in superpanel_dict:
-            panel_data = superpanel_dict[panelapp_id]
-
-            # need to gather genes in the superpanel using the subpanels
-            hgnc_ids = set()
-
-            for subpanel in superpanel_dict[panelapp_id]["subpanels"]:
-                hgnc_ids.update(panelapp_dict[subpanel]["genes"])
-        else:
-            # should have been caught by the check just before
-            raise Exception(
-                f"Panel {panelapp_id} broke through the check. "
-                "He's too powerful, let him through"
-            )
+        panel_data, hgnc_ids = dump_data
 
         # check if the attributes stored are correct
         if name != panel_data["name"]:
@@ -376,15 +518,13 @@ def check_panels(
                 f"Data associated with the panel {panelapp_id} is not "
                 "correct. Check the logs for more info"
             )
-            panel_log[panelapp_id]["errors"].append(msg)
-            panel_log[panelapp_id]["errors"].append(
+            errors.append(msg)
+            errors.append(
                 f"{name} != {panel_data['name']}"
             )
 
         # get the panel type
-        panel_type = session.query(panel_type_tb.c.type).filter(
-            panel_type_tb.c.id == panel_type_pk
-        ).one()[0]
+        panel_type = panel_types[panel_type_pk]
 
         # check if it matches the one gathered in panelapp data
         if panel_type != panel_data["type"]:
@@ -392,40 +532,30 @@ def check_panels(
                 f"Panel type in the panelapp dump ({panel_data['type']}) and "
                 f"stored in the db ({panel_type}) are different"
             )
-            panel_log[panelapp_id]["errors"].append(msg)
+            errors.append(msg)
 
         # get all the links to the feature table using the panel primary key
-        db_panel2features = session.query(
-            panel_features_tb.c.feature_id, panel_features_tb.c.panel_version
-        ).filter(
-            panel_features_tb.c.panel_id == panel_pk
-        ).all()
+        db_panel2features = panel2features[panel_pk]
 
         # check the links
         feature_log = check_panel2features(
-            session, db_panel2features, hgnc_ids, feature_tb, gene_tb,
-            feature_type_tb, panel_data["version"]
+            db_panel2features, hgnc_ids, panel_data["version"]
         )
 
-        panel_log[panelapp_id]["feature_errors"] = feature_log
+        panel_entry["feature_errors"] = feature_log
 
     return nb_error, panel_log
 
 
 def check_panel2features(
-    session, db_panel2features: list, hgnc_ids: list, feature_tb, gene_tb,
-    feature_type_tb, panel_version: str
+    db_panel2features: list, hgnc_ids: set, panel_version: str
 ):
     """ Check links from panels to features
 
     Args:
-        session (SQL Alchemy session): SQL Alchemy session
-        db_panel2features (list): List of panel2feature rows gathered for
-                                    specific panel
-        hgnc_ids (list): List of hgnc ids gathered for the panel
-        feature_tb: SQL Alchemy queryable table for features
-        gene_tb: SQL Alchemy queryable table for genes
-        feature_type_tb: SQL Alchemy queryable table for feature types
+        db_panel2features (list): List of (feature pk, panel version, hgnc id,
+                                    feature type) gathered for specific panel
+        hgnc_ids (set): Set of hgnc ids gathered for the panel
         panel_version (str): Panel version
 
     Returns:
@@ -442,104 +572,64 @@ def check_panel2features(
         )
         error_log.append(msg)
 
-    for feature_pk, version in db_panel2features:
+    # compare the genes of the dump and the genes linked to the panel in the
+    # db as sets as a count mismatch doesn't catch the same number of
+    # different genes
+    db_hgnc_id2feature = {
+        hgnc_id: feature_pk
+        for feature_pk, version, hgnc_id, feature_type in db_panel2features
+    }
+    missing_hgnc_ids = hgnc_ids - db_hgnc_id2feature.keys()
+    extra_hgnc_ids = db_hgnc_id2feature.keys() - hgnc_ids
+
+    if missing_hgnc_ids:
+        msg = (
+            "Genes in the panelapp dump not linked to the panel in the db: "
+            f"{', '.join(sorted(missing_hgnc_ids))}"
+        )
+        error_log.append(msg)
+
+    # point at the offending features rather than dumping all the panel genes
+    if extra_hgnc_ids:
+        extra_genes = [
+            f"{hgnc_id} (feature {db_hgnc_id2feature[hgnc_id]})"
+            for hgnc_id in sorted(extra_hgnc_ids, key=str)
+        ]
+        msg = (
+            "Genes linked to the panel in the db not in the panelapp dump: "
+            f"{', '.join(extra_genes)}"
+        )
+        error_log.append(msg)
+
+    # parse the panel version once and only compare the distinct versions
+    # stored in the db as the links of a panel mostly share the same version
+    expected_version = float(panel_version)
+    db_versions = {
+        version for feature_pk, version, hgnc_id, feature_type
+        in db_panel2features
+    }
+
+    for version in sorted(db_versions):
         # compare the version from the database and the panel version
-        if float(version) != float(panel_version):
+        if float(version) != expected_version:
             msg = (
                 f"Version of panel used for features are not equal: {version} "
                 f"(db) vs {panel_version} (dump)"
             )
             error_log.append(msg)
 
-        # check if the feature is correct by querying the gene tb using the
-        # feature pk
-        feature_log_msg = check_feature(
-            session, feature_pk, hgnc_ids, feature_tb, gene_tb,
-        )
-
-        if feature_log_msg is not None:
-            error_log.append(feature_log_msg)
-
-        # check if the feature type is correct by querying the feature type tb
-        # using the feature pk
-        feature_type_log_msg = check_feature_type(
-            session, "gene", feature_pk, feature_tb, feature_type_tb
-        )
-
-        if feature_type_log_msg is not None:
-            error_log.append(feature_type_log_msg)
+    for feature_pk, version, hgnc_id, feature_type in db_panel2features:
+        # check if the feature type is correct
+        if feature_type != "gene":
+            msg = (
+                f"The feature type {feature_type} associated with feature "
+                f"{feature_pk} is not the expected feature type 'gene'"
+            )
+            error_log.append(msg)
 
     return error_log
 
 
-def check_feature(
-    session, feature_pk: int, hgnc_ids: list, feature_tb, gene_tb
-):
-    """ Check if feature is linked to the correct hgnc_id
-
-    Args:
-        session (SQL Alchemy session): SQL Alchemy session
-        feature_pk (int): Primary key of the feature
-        hgnc_ids (list): List of hgnc ids gathered for the panel
-        feature_tb: SQL Alchemy queryable table for features
-        gene_tb: SQL Alchemy queryable table for genes
-
-    Returns:
-        str: Error msg
-    """
-
-    msg = None
-
-    # get the hgnc id from the db using the given feature primary key
-    hgnc_id = session.query(gene_tb.c.hgnc_id).outerjoin(feature_tb).filter(
-        feature_tb.c.id == feature_pk
-    ).one()[0]
-
-    if hgnc_id not in hgnc_ids:
-        msg = (
-            f"Gene {hgnc_id} is not in the genes gathered in the "
-            f"panelapp dump: {hgnc_ids}"
-        )
-
-    return msg
-
-
-def check_feature_type(
-    session, expected_feature_type: str, feature_pk: int, feature_tb,
-    feature_type_tb
-):
-    """ Check if feature type is correct for given feature primary key
-
-    Args:
-        session (SQL Alchemy session): SQL Alchemy session
-        expected_feature_type (str): Expected feature type
-        feature_pk (int): Primary key of the feature
-        feature_tb: SQL Alchemy queryable table for features
-        feature_type_tb: SQL Alchemy queryable table for feature types
-
-    Returns:
-        str: Error msg
-    """
-
-    msg = None
-
-    # get the feature type for the given feature primary key
-    feature_type = session.query(
-        feature_type_tb.c.type
-    ).outerjoin(feature_tb).filter(
-        feature_tb.c.id == feature_pk
-    ).one()[0]
-
-    if feature_type != expected_feature_type:
-        msg = (
-            f"The feature type {feature_type} associated with "
-            f"feature {feature_pk} is not the expected feature type "
-            f"'{expected_feature_type}'"
-        )
-
-    return msg
-
-
 def check_g2t(
     session, gene_dict: dict, g2t_data: dict, gene_tb, g2t_tb, transcript_tb
 ):
@@ -559,13 +649,27 @@ def check_g2t(
 
     error_log = []
 
+    # get the transcripts of every gene with their attributes in one query
+    # and group them using the hgnc id
+    gene2transcripts = defaultdict(list)
+
+    for (
+        hgnc_id, db_clinical_transcript, tx_pk, refseq_base, version,
+        canonical
+    ) in session.query(
+        gene_tb.c.hgnc_id, g2t_tb.c.clinical_transcript,
+        g2t_tb.c.transcript_id, transcript_tb.c.refseq_base,
+        transcript_tb.c.version, transcript_tb.c.canonical
+    ).select_from(g2t_tb).join(gene_tb).join(
+        transcript_tb, transcript_tb.c.id == g2t_tb.c.transcript_id
+    ).yield_per(1000):
+        gene2transcripts[hgnc_id].append(
+            (db_clinical_transcript, tx_pk, refseq_base, version, canonical)
+        )
+
     for hgnc_id in gene_dict:
         all_transcripts = g2t_data[hgnc_id]
-
-        # get the genes2transcripts for the hgnc id
-        db_g2t = session.query(g2t_tb).join(gene_tb).filter(
-            gene_tb.c.hgnc_id == hgnc_id
-        ).all()
+        db_g2t = gene2transcripts.get(hgnc_id, [])
 
         if len(db_g2t) != len(all_transcripts):
             msg = (
@@ -574,7 +678,7 @@ def check_g2t(
                 f"in the nirvana gff ({len(all_transcripts)})"
             )
             error_log.append(msg)
-            tx_pks = [data[4] for data in db_g2t]
+            tx_pks = [str(g2t_row[1]) for g2t_row in db_g2t]
             msg_pks = (
                 f"Primary keys of transcripts linked to {hgnc_id}: "
                 f"{', '.join(tx_pks)}"
@@ -586,55 +690,81 @@ def check_g2t(
             error_log.append(msg_pks)
             error_log.append(msg_tx)
 
+        # find the clinical transcripts of the gene once for all its rows
+        clinical_transcripts = [
+            tx
+            for tx, (is_clinical, _) in all_transcripts.items()
+            if is_clinical is True
+        ]
+        clinical_transcript = next(iter(clinical_transcripts), None)
+
+        # compare the transcripts with their statuses as sets in one go, the
+        # rows only need to be checked one by one to report the differences
+        expected_transcripts = {
+            (tx, is_clinical is True, canonical_status)
+            for tx, (is_clinical, canonical_status) in all_transcripts.items()
+        }
+        stored_transcripts = {
+            (
+                f"{refseq_base}.{version}",
+                DB_FLAG_TO_BOOL.get(db_clinical_transcript),
+                DB_FLAG_TO_BOOL.get(canonical)
+            )
+            for (
+                db_clinical_transcript, tx_pk, refseq_base, version, canonical
+            ) in db_g2t
+        }
+
+        if (
+            stored_transcripts == expected_transcripts and
+            len(clinical_transcripts) <= 1
+        ):
+            continue
+
         # loop through the g2t
-        for pk, db_clinical_transcript, date, gene_pk, ref_pk, tx_pk in db_g2t:
-            # get the transcript data from the db
-            tx_id, refseq_base, version, canonical = session.query(
-                transcript_tb
-            ).filter(
-                transcript_tb.c.id == tx_pk
-            ).one()
+        for (
+            db_clinical_transcript, tx_pk, refseq_base, version, canonical
+        ) in db_g2t:
+            # format the transcript once, it is used as the key of the g2t
+            # file data and in the messages
+            transcript = f"{refseq_base}.{version}"
+
+            # a transcript stored in the db but absent from the g2t file is
+            # reported and the remaining transcripts are still checked
+            if transcript not in all_transcripts:
+                msg = (
+                    f"{hgnc_id}, {transcript}: Transcript stored "
+                    "in the database is not in the g2t file"
+                )
+                error_log.append(msg)
+                continue
 
             # get the transcript data from the nirvana/hgmd dumps
-            (
-                clinical_status, canonical_status
-            ) = all_transcripts[f"{refseq_base}.{version}"]
+            clinical_status, canonical_status = all_transcripts[transcript]
 
-            if canonical == 0:
-                canonical = False
-            elif canonical == 1:
-                canonical = True
-            else:
-                canonical = None
+            canonical = DB_FLAG_TO_BOOL.get(canonical)
 
             if db_clinical_transcript:
-                try:
-                    clinical_transcript = [
-                        tx
-                        for tx in g2t_data[hgnc_id]
-                        if g2t_data[hgnc_id][tx][0] is True
-                    ][0]
-                except IndexError as e:
+                if clinical_transcript is None:
                     msg = (
                         f"{hgnc_id} has no clinical_transcript"
                     )
                     error_log.append(msg)
-                    debug = g2t_data[hgnc_id]
-                    error_log.append(debug)
+                    error_log.append(all_transcripts)
                     continue
 
-                if f"{refseq_base}.{version}" != clinical_transcript:
+                if transcript != clinical_transcript:
                     msg = (
-                        f"{hgnc_id}, {refseq_base}.{version}: Clinical "
+                        f"{hgnc_id}, {transcript}: Clinical "
                         f"transcript gathered is {clinical_transcript} vs db "
-                        f"is {refseq_base}.{version}"
+                        f"is {transcript}"
                     )
                     error_log.append(msg)
 
             # check if the attributes are correct
             if canonical_status != canonical:
                 msg = (
-                    f"{hgnc_id}, {refseq_base}.{version}: Canonical status "
+                    f"{hgnc_id}, {transcript}: Canonical status "
                     f"between dump ({canonical_status}) and db "
                     f"({canonical}) are not equal"
                 )
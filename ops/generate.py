@@ -1,5 +1,7 @@
 import json
 
+from sqlalchemy import bindparam
+
 from ops.logger import setup_logging, output_to_loggers
 from ops.utils import (
     get_date, write_new_output_folder, parse_gemini_dump,
@@ -7,12 +9,17 @@ from ops.utils import (
     gather_panel_types_django_json, gather_feature_types_django_json,
     gather_panel_data_django_json, gather_superpanel_data_django_json,
     gather_transcripts, gather_clinical_indication_data_django_json,
-    get_clinical_indication_through_genes, get_latest_clinical_indication_data
+    get_clinical_indication_through_genes, get_latest_clinical_indication_data,
+    chunk_values
 )
 
 
 CONSOLE, GENERATION = setup_logging("generation")
 
+# buffer size of the output files, the rows are small so a larger buffer
+# reduces the number of write calls
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
 
 def generate_panelapp_tsvs(all_panels: dict, type_panel: str):
     """ Generate tsv for every panelapp panel
@@ -41,13 +48,21 @@ def generate_panelapp_tsvs(all_panels: dict, type_panel: str):
                 f"{panel.get_name()}_{panel.get_version()}_superpanel.tsv"
             )
 
-            with open(f"{output_folder}/{superpanel_output}", "w") as f:
-                for subpanel_id, subpanel, version in subpanels:
-                    f.write((
-                        f"{panel.get_id()}\t{panel.get_name()}\t"
-                        f"{panel.get_version()}\t{panel.is_signedoff()}\t"
-                        f"{subpanel_id}\t{subpanel}\t{version}\n"
-                    ))
+            # the superpanel columns are the same for every subpanel row
+            superpanel_columns = (
+                f"{panel.get_id()}\t{panel.get_name()}\t"
+                f"{panel.get_version()}\t{panel.is_signedoff()}"
+            )
+
+            with open(
+                f"{output_folder}/{superpanel_output}", "w",
+                buffering=OUTPUT_BUFFER_SIZE
+            ) as f:
+                f.writelines(
+                    f"{superpanel_columns}\t{subpanel_id}\t{subpanel}\t"
+                    f"{version}\n"
+                    for subpanel_id, subpanel, version in subpanels
+                )
         # else just write the panel using the existing method
         else:
             panel.write(output_folder)
@@ -77,12 +92,13 @@ def generate_genepanels(session, meta, hgnc_data: dict):
     ci_tb = meta.tables["clinical_indication"]
     ci2panels_tb = meta.tables["clinical_indication_panels"]
 
-    # get the gemini names and associated panels ids
+    # get the gemini names and associated panels ids, streamed as the rows
+    # are only read once to get the latest data of every clinical indication
     cis = session.query(
         ci_tb.c.gemini_name, ci2panels_tb.c.panel_id, ci2panels_tb.c.ci_version
     ).join(
         ci2panels_tb, ci_tb.c.id == ci2panels_tb.c.clinical_indication_id
-    ).all()
+    ).yield_per(1000)
 
     ci2panels = get_latest_clinical_indication_data(cis)
 
@@ -109,10 +125,8 @@ def generate_genepanels(session, meta, hgnc_data: dict):
     output_folder = write_new_output_folder("sql_dump", "genepanels")
     output_file = f"{output_folder}/{get_date()}_genepanels.tsv"
 
-    with open(output_file, "w") as f:
-        for row in sorted_output_data:
-            data = "\t".join(row)
-            f.write(f"{data}\n")
+    with open(output_file, "w", buffering=OUTPUT_BUFFER_SIZE) as f:
+        f.writelines("\t".join(row) + "\n" for row in sorted_output_data)
 
     msg = f"Created genepanels file: {output_file}"
     output_to_loggers(msg, "info", CONSOLE, GENERATION)
@@ -142,6 +156,8 @@ def generate_g2t(session, meta, reference_id: int):
 
     # get the all the data that g2t requires:
     # hgnc id, transcript, clinical status, canonical status
+    # the rows are only read once so stream them in batches instead of
+    # loading the whole table in memory
     g2t_data = session.query(
         gene_tb.c.hgnc_id, tx_tb.c.refseq_base, tx_tb.c.version,
         g2t_tb.c.clinical_transcript, tx_tb.c.canonical
@@ -151,7 +167,7 @@ def generate_g2t(session, meta, reference_id: int):
         tx_tb, tx_tb.c.id == g2t_tb.c.transcript_id
     ).filter(
         g2t_tb.c.reference_id == reference_id
-    ).all()
+    ).yield_per(1000)
 
     data = []
 
@@ -177,10 +193,8 @@ def generate_g2t(session, meta, reference_id: int):
     output_folder = write_new_output_folder("sql_dump", "g2t")
     output_file = f"{output_folder}/{get_date()}_g2t.tsv"
 
-    with open(output_file, "w") as f:
-        for row in sorted_data:
-            data = "\t".join(row)
-            f.write(f"{data}\n")
+    with open(output_file, "w", buffering=OUTPUT_BUFFER_SIZE) as f:
+        f.writelines("\t".join(row) + "\n" for row in sorted_data)
 
     msg = f"Created g2t file: {output_file}"
     output_to_loggers(msg, "info", CONSOLE, GENERATION)
@@ -282,7 +296,9 @@ def generate_django_jsons(
     output_file = f"{output_folder}/{today}_json_dump.json"
 
     # write the single json containing all the elements in the database
-    with open(output_file, "w", encoding="utf-8") as f:
+    with open(
+        output_file, "w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE
+    ) as f:
         json.dump(all_elements, f, indent=4)
 
     # write single json for every table in the db
@@ -291,7 +307,10 @@ def generate_django_jsons(
         table_output = f"{today}_{table}.json"
         output_file = f"{output_folder}/{table_output}"
 
-        with open(output_file, "w", encoding="utf-8") as f:
+        with open(
+            output_file, "w", encoding="utf-8",
+            buffering=OUTPUT_BUFFER_SIZE
+        ) as f:
             json.dump(data, f, indent=4)
 
     msg = f"Created json dump for django import: {output_folder}"
@@ -329,14 +348,23 @@ def generate_manifest(session, meta, gemini_dump: str, hgnc_data: dict):
         for panel in ele
     ])
 
-    # get the gemini names and associated genes and panels ids
-    ci_in_manifest = session.query(
+    ci_in_manifest = []
+
+    # get the gemini names and associated genes and panels ids, built once
+    # with a bound IN list that is executed in chunks to keep the IN clause to
+    # a reasonable size
+    ci_query = session.query(
         ci_tb.c.gemini_name, ci2panels_tb.c.panel_id, ci2panels_tb.c.ci_version
     ).join(
         ci2panels_tb, ci_tb.c.id == ci2panels_tb.c.clinical_indication_id
     ).filter(
-        ci_tb.c.gemini_name.in_(uniq_used_panels)
-    ).all()
+        ci_tb.c.gemini_name.in_(bindparam("gemini_names", expanding=True))
+    )
+
+    for gemini_names in chunk_values(uniq_used_panels):
+        ci_in_manifest.extend(
+            ci_query.params(gemini_names=gemini_names).all()
+        )
 
     ci2panels = get_latest_clinical_indication_data(ci_in_manifest)
 
@@ -373,10 +401,8 @@ def generate_manifest(session, meta, gemini_dump: str, hgnc_data: dict):
     output_folder = write_new_output_folder("sql_dump", "bio_manifest")
     output_file = f"{output_folder}/{get_date()}_bio_manifest.tsv"
 
-    with open(output_file, "w") as f:
-        for row in sorted_output_data:
-            data = "\t".join(row)
-            f.write(f"{data}\n")
+    with open(output_file, "w", buffering=OUTPUT_BUFFER_SIZE) as f:
+        f.writelines("\t".join(row) + "\n" for row in sorted_output_data)
 
     msg = f"Created sample2panels file: {output_file}"
     output_to_loggers(msg, "info", CONSOLE, GENERATION)
@@ -3,6 +3,10 @@ import logging.config
 from ops.config import path_to_logs
 
 
+# whether the logging config has already been loaded
+_CONFIGURED = False
+
+
 def setup_logging(type_logger):
     """ Return appropriate logger given name of logger
 
@@ -13,6 +17,20 @@ def setup_logging(type_logger):
         logger: Logger object
     """
 
+    global _CONFIGURED
+
+    # the config sets up all the loggers, load it only once so that every
+    # module importing the loggers doesn't recreate the handlers
+    if not _CONFIGURED:
+        configure_logging()
+        _CONFIGURED = True
+
+    return logging.getLogger("normal_ops"), logging.getLogger(type_logger)
+
+
+def configure_logging():
+    """ Load the logging config for all the loggers """
+
     logging.config.dictConfig({
         "version": 1,
         "disable_existing_loggers": False,
@@ -92,8 +110,6 @@ def setup_logging(type_logger):
         }
     })
 
-    return logging.getLogger("normal_ops"), logging.getLogger(type_logger)
-
 
 def output_to_loggers(msg: str, level: str, *loggers):
     """ Add msgs to the all the loggers given
@@ -106,3 +122,5 @@ def output_to_loggers(msg: str, level: str, *loggers):
             logger.info(msg)
         elif level == "warning":
             logger.warning(msg)
+        elif level == "error":
+            logger.error(msg)
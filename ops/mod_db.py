@@ -1,3 +1,4 @@
+from collections import defaultdict
 import datetime
 import os
 import sys
@@ -11,7 +12,7 @@ from ops.config import path_to_panel_palace
 from ops.logger import setup_logging, output_to_loggers
 from ops.utils import (
     get_date, parse_hgnc_dump, parse_g2t, parse_panel_form,
-    get_latest_panel_version
+    get_latest_panel_version, chunk_values
 )
 
 sys.path.append(path_to_panel_palace)
@@ -80,26 +81,25 @@ def import_hgnc_dump(path_to_hgnc_dump: str, date: str):
         app_label="panel_database", model_name="hgnc_current"
     )
 
-    all_current_entries = hgnc_current.objects.all()
-
-    # Check if there's data in the hgnc current table
-    if all_current_entries:
+    # Check if there's data in the hgnc current table without fetching the
+    # rows of the table
+    if hgnc_current.objects.exists():
         # Delete everything
         hgnc_current.objects.all().delete()
 
     # Loop through the 2 tables, need to import the same data twice
-    for model in [hgnc_current, hgnc_new]:
-        # Loop through the data in the hgnc dump
-        for hgnc_id in hgnc_data:
-            # Add the hgnc_id in the hgnc data
-            data = dict({"hgnc_id": hgnc_id}, **hgnc_data[hgnc_id])
-            # Create the object with all the data from the dump
-            obj = model(**data)
-            # So there's this method called bulk_create() and I tried using
-            # that but I kept getting this following error
-            # django.db.utils.OperationalError: (2006, 'MySQL server has gone away')
-            # So yeah, looping and saving, might be slower but works
-            obj.save()
+    with transaction.atomic():
+        for model in [hgnc_current, hgnc_new]:
+            # Create the objects with all the data from the dump, adding the
+            # hgnc_id in the hgnc data
+            objs = [
+                model(hgnc_id=hgnc_id, **hgnc_data[hgnc_id])
+                for hgnc_id in hgnc_data
+            ]
+            # bulk_create() in one go exceeds the max_allowed_packet of the
+            # server (2006, 'MySQL server has gone away') so insert the rows
+            # in batches of multi-row INSERTs
+            model.objects.bulk_create(objs, batch_size=1000)
 
     msg = (
         f"Finished importing data using: '{path_to_hgnc_dump}' in "
@@ -124,74 +124,123 @@ def import_new_g2t(path_to_g2t_file: str, reference_id: int):
     date = datetime.date.today()
 
     g2t_data = parse_g2t(path_to_g2t_file)
-    g2t_rows = Genes2transcripts.objects.all()
 
-    for gene in g2t_data:
-        new_gene, gene_created = Gene.objects.get_or_create(
-            hgnc_id=gene
-        )
-        new_feature, feature_created = Feature.objects.get_or_create(
-            gene_id=new_gene.id, feature_type_id=1
-        )
+    # get the existing g2t rows of the reference in one query instead of
+    # filtering them for every transcript of the g2t file
+    existing_g2t = {}
+    # keys of several rows, only an error if the g2t file looks one of them up
+    duplicated_g2t = defaultdict(list)
+
+    for (
+        g2t_pk, hgnc_id, refseq_base, tx_version, canonical,
+        clinical_transcript
+    ) in Genes2transcripts.objects.filter(
+        reference_id=reference_id
+    ).values_list(
+        "id", "gene__hgnc_id", "transcript__refseq_base",
+        "transcript__version", "transcript__canonical", "clinical_transcript"
+    ).iterator():
+        # a NULL canonical status never matched the canonical status of the
+        # g2t file
+        if canonical is None:
+            continue
+
+        key = (hgnc_id, refseq_base, str(tx_version), canonical)
+
+        if key in existing_g2t:
+            if key not in duplicated_g2t:
+                duplicated_g2t[key].append(existing_g2t[key][0])
+
+            duplicated_g2t[key].append(g2t_pk)
+
+        existing_g2t[key] = (g2t_pk, clinical_transcript)
+
+    # messages for the created and updated rows go to the mod_db log as they
+    # happen but are gathered for the console, which is written in one go
+    # rather than flushed for every row
+    console_msgs = []
 
-        if gene_created:
-            msg = (
-                f"Created gene and feature for {gene}: {new_gene}, "
-                f"{new_feature}"
+    def log_import_msg(msg):
+        MOD_DB.info(msg)
+        console_msgs.append(msg)
+
+    def flush_console_msgs():
+        if console_msgs:
+            CONSOLE.info("\n".join(console_msgs))
+            console_msgs.clear()
+
+    try:
+        for gene in g2t_data:
+            new_gene, gene_created = Gene.objects.get_or_create(
+                hgnc_id=gene
+            )
+            new_feature, feature_created = Feature.objects.get_or_create(
+                gene_id=new_gene.id, feature_type_id=1
             )
-            output_to_loggers(msg, "info", CONSOLE, MOD_DB)
-
-        for transcript, statuses in g2t_data[gene].items():
-            refseq, version = transcript.split(".")
-            clinical, canonical = statuses
-
-            filter_dict = {
-                "gene__hgnc_id": gene,
-                "transcript__refseq_base": refseq,
-                "transcript__version": version,
-                "transcript__canonical": canonical,
-                "reference_id": reference_id
-            }
 
-            row = g2t_rows.filter(**filter_dict)
+            if gene_created:
+                msg = (
+                    f"Created gene and feature for {gene}: {new_gene}, "
+                    f"{new_feature}"
+                )
+                log_import_msg(msg)
 
-            if row:
-                clinical_transcript = row.values_list(
-                    "clinical_transcript", flat=True
-                ).get()
+            for transcript, statuses in g2t_data[gene].items():
+                refseq, version = transcript.split(".")
+                clinical, canonical = statuses
 
-                if clinical_transcript != clinical:
-                    msg = (
-                        "Updating genes2transcripts row "
-                        f"'{row.values('id').get()}' - Clinical status "
-                        f"{clinical_transcript} --> {clinical}, updating "
-                        "date as well"
+                key = (gene, refseq, version, canonical)
+
+                if key in duplicated_g2t:
+                    raise Exception(
+                        f"Multiple genes2transcripts rows found for {key}: "
+                        f"{duplicated_g2t[key]}"
                     )
-                    output_to_loggers(msg, "info", CONSOLE, MOD_DB)
-                    row.update(clinical_transcript=clinical, date=date)
-            else:
-                new_tx, tx_created = Transcript.objects.get_or_create(
-                    refseq_base=refseq, version=version, canonical=canonical
-                )
-                new_g2t, g2t_created = Genes2transcripts.objects.get_or_create(
-                    gene_id=new_gene.id, reference_id=reference_id, date=date,
-                    transcript_id=new_tx.id, clinical_transcript=clinical
-                )
 
-                if (tx_created and not g2t_created) or (not tx_created and g2t_created):
-                    msg = (
-                        "One of the following row already existed: "
-                        f"{new_tx} {tx_created} | "
-                        f"{new_g2t} {g2t_created}."
-                        "Please check that there is no underlying issues."
+                row = existing_g2t.get(key)
+
+                if row:
+                    g2t_pk, clinical_transcript = row
+
+                    if clinical_transcript != clinical:
+                        msg = (
+                            f"Updating genes2transcripts row '{g2t_pk}' - "
+                            f"Clinical status {clinical_transcript} --> "
+                            f"{clinical}, updating date as well"
+                        )
+                        log_import_msg(msg)
+                        Genes2transcripts.objects.filter(id=g2t_pk).update(
+                            clinical_transcript=clinical, date=date
+                        )
+                else:
+                    new_tx, tx_created = Transcript.objects.get_or_create(
+                        refseq_base=refseq, version=version, canonical=canonical
                     )
-                    output_to_loggers(msg, "warning", CONSOLE, MOD_DB)
-                elif tx_created and g2t_created:
-                    msg = (
-                        f"The following objects have been created: {new_tx}, "
-                        f"{new_g2t}"
+                    new_g2t, g2t_created = Genes2transcripts.objects.get_or_create(
+                        gene_id=new_gene.id, reference_id=reference_id, date=date,
+                        transcript_id=new_tx.id, clinical_transcript=clinical
                     )
-                    output_to_loggers(msg, "info", CONSOLE, MOD_DB)
+
+                    if (tx_created and not g2t_created) or (not tx_created and g2t_created):
+                        msg = (
+                            "One of the following row already existed: "
+                            f"{new_tx} {tx_created} | "
+                            f"{new_g2t} {g2t_created}."
+                            "Please check that there is no underlying issues."
+                        )
+                        # keep the console in the order of the rows
+                        flush_console_msgs()
+                        output_to_loggers(msg, "warning", CONSOLE, MOD_DB)
+                    elif tx_created and g2t_created:
+                        msg = (
+                            f"The following objects have been created: {new_tx}, "
+                            f"{new_g2t}"
+                        )
+                        log_import_msg(msg)
+    finally:
+        # also write the gathered messages if the import stops midway as the
+        # rows processed until then are already in the database
+        flush_console_msgs()
 
     msg = (
         f"Finished importing new g2t data using: '{path_to_g2t_file}'"
@@ -234,10 +283,17 @@ def import_panel_form_data(panel_form: str):
 
     # bool to indicate if single gene panels are involved
     single_gene_panel = False
-    # get the panel type matching the single gene type
-    sg_panel_type_id = PanelType.objects.get(type="single_gene").id
-    # get the panel type matching the in-house type
-    in_house_panel_type_id = PanelType.objects.get(type="in-house").id
+    # get the panel types matching the single gene and in-house types in one
+    # query
+    panel_type_ids = dict(
+        PanelType.objects.filter(
+            type__in=["single_gene", "in-house"]
+        ).values_list("type", "id")
+    )
+    sg_panel_type_id = panel_type_ids["single_gene"]
+    in_house_panel_type_id = panel_type_ids["in-house"]
+    # get the gene feature type id
+    gene_feature_type_id = FeatureType.objects.get(type="gene").id
 
     for ci in data:
         ci_data = data[ci]
@@ -327,9 +383,6 @@ def import_panel_form_data(panel_form: str):
                     msg = f"Gene {new_gene.hgnc_id} created: {new_gene.id}"
                     output_to_loggers(msg, "info", CONSOLE, MOD_DB)
 
-                # get the gene feature type id
-                gene_feature_type_id = FeatureType.objects.get(type="gene").id
-
                 # create feature
                 new_feature, feature_created = Feature.objects.get_or_create(
                     gene_id=new_gene.id, feature_type_id=gene_feature_type_id
@@ -455,15 +508,19 @@ def update_panelapp_panel(panelapp_id: int, version: str):
     # get panelapp panel
     panel = Panelapp.Panel(panelapp_id, version)
     genes = [gene["hgnc_id"] for gene in panel.get_genes(3)]
-    # get all genes in database
-    db_genes = Gene.objects.all().values_list("hgnc_id", flat=True)
-
-    missing_genes = []
+    # get the genes of the panel present in the database rather than all
+    # the genes in the database
+    db_genes = set()
+
+    for chunk in chunk_values(genes):
+        db_genes.update(
+            Gene.objects.filter(hgnc_id__in=chunk).values_list(
+                "hgnc_id", flat=True
+            )
+        )
 
     # check all genes are present in the database
-    for gene in genes:
-        if gene not in db_genes:
-            missing_genes.append(gene)
+    missing_genes = [gene for gene in genes if gene not in db_genes]
 
     if missing_genes:
         raise Exception(
@@ -482,17 +539,57 @@ def update_panelapp_panel(panelapp_id: int, version: str):
         "info", CONSOLE, MOD_DB
     )
 
+    # get the feature ids of the genes instead of one query per gene, in
+    # chunks to keep the IN clause to a reasonable size for big panels
+    gene2feature_ids = defaultdict(list)
+
+    for chunk in chunk_values(dict.fromkeys(genes)):
+        for hgnc_id, feature_id in Feature.objects.filter(
+            gene__hgnc_id__in=chunk
+        ).values_list("gene__hgnc_id", "id"):
+            gene2feature_ids[hgnc_id].append(feature_id)
+
+    genes_without_feature = [
+        gene for gene in genes if gene not in gene2feature_ids
+    ]
+
+    if genes_without_feature:
+        raise Exception(
+            "The following genes don't have a feature in the database: "
+            f"{genes_without_feature}"
+        )
+
+    genes_with_multiple_features = {
+        gene: feature_ids
+        for gene, feature_ids in gene2feature_ids.items()
+        if len(feature_ids) > 1
+    }
+
+    if genes_with_multiple_features:
+        raise Exception(
+            "The following genes have multiple features in the database: "
+            f"{genes_with_multiple_features}"
+        )
+
+    gene2feature_id = {
+        gene: feature_ids[0]
+        for gene, feature_ids in gene2feature_ids.items()
+    }
+
+    # get the features already linked to that panel version, no need to
+    # filter on the features as only the ones of the panel are linked to it
+    linked_feature_ids = set(
+        PanelFeatures.objects.filter(
+            panel_version=version, panel_id=db_panel_id
+        ).values_list("feature_id", flat=True)
+    )
+
     for gene in genes:
         # get the feature id of the gene
-        db_feature_id = Feature.objects.get(gene__hgnc_id=gene).id
+        db_feature_id = gene2feature_id[gene]
 
         # check if panel version already linked to feature
-        panel_link = PanelFeatures.objects.filter(
-            panel_version=version, feature_id=db_feature_id,
-            panel_id=db_panel_id
-        )
-
-        if panel_link:
+        if db_feature_id in linked_feature_ids:
             raise Exception((
                 f"That version '{version}' of the panel '{panelapp_id}' is "
                 f"already linked to that feature '{db_feature_id}'"
@@ -560,8 +657,11 @@ def create_objects_for_td(td_data, ci_to_keep):
 
     # get the objects for a few required fields in the panel and the feature
     # tables
-    single_gene_panel_type = PanelType.objects.get(type="single_gene")
-    gms_panel_type = PanelType.objects.get(type="gms")
+    panel_type_ids = dict(
+        PanelType.objects.filter(
+            type__in=["single_gene", "gms"]
+        ).values_list("type", "id")
+    )
     feature_type = FeatureType.objects.get(type="gene")
 
     output_to_loggers(
@@ -569,7 +669,18 @@ def create_objects_for_td(td_data, ci_to_keep):
         "info", MOD_DB, CONSOLE
     )
 
-    codes_of_cis_to_be_kept = [ci.code for ci, panel in ci_to_keep]
+    codes_of_cis_to_be_kept = {ci.code for ci, panel in ci_to_keep}
+
+    # extract date of the source for the clinical indication versions, it is
+    # the same for every link so parse it once
+    td_date, td_type = td_data["config_source"].split("_")
+    td_date_str = datetime.datetime.strptime(
+        td_date, "%y%m%d"
+    ).strftime("%Y-%m-%d")
+    ci_version = f"TD_{td_date_str}"
+    panel_feature_description = (
+        f"Update test directory: {td_data['config_source']}"
+    )
 
     # go through all the indications
     for indication in td_data["indications"]:
@@ -597,24 +708,29 @@ def create_objects_for_td(td_data, ci_to_keep):
                     if "HGNC:" in panel:
                         panel_obj, created = Panel.objects.get_or_create(
                             name=f"{panel}_SG_panel", panelapp_id="",
-                            panel_type_id=single_gene_panel_type.id
+                            panel_type_id=panel_type_ids["single_gene"]
                         )
                         genes.add(panel)
+                        # assign default version to the single gene panels
+                        panel_version = "1.0.0"
 
                     # panelapp panel id
                     else:
+                        signedoff_panel = signedoff_panels.get(int(panel))
+
                         # check if the panel is in the signedoff panel dump
                         # R59.3 points to an internal panel for example
-                        if int(panel) in signedoff_panels:
+                        if signedoff_panel is not None:
                             panel_obj, created = Panel.objects.get_or_create(
-                                name=signedoff_panels[int(panel)].name,
+                                name=signedoff_panel.name,
                                 panelapp_id=panel,
-                                panel_type_id=gms_panel_type.id
+                                panel_type_id=panel_type_ids["gms"]
                             )
                             genes.update([
                                 gene["hgnc_id"]
-                                for gene in signedoff_panels[int(panel)].get_genes(3)
+                                for gene in signedoff_panel.get_genes(3)
                             ])
+                            panel_version = signedoff_panel.version
                         else:
                             msg = (
                                 f"{ci_obj.code} points to an unaccessible "
@@ -630,37 +746,16 @@ def create_objects_for_td(td_data, ci_to_keep):
                             feature_type_id=feature_type.id, gene=gene_obj
                         )
 
-                        # get the version of the panel
-                        if (
-                            panel_obj.panelapp_id and
-                            int(panel_obj.panelapp_id) in signedoff_panels
-                        ):
-                            panel_version = signedoff_panels[
-                                int(panel_obj.panelapp_id)
-                            ].version
-                        else:
-                            # assign default version to the single gene panels
-                            panel_version = "1.0.0"
-
                         # create the panelfeature object
                         pf_link = PanelFeatures.objects.get_or_create(
-                            panel_version=panel_version, description=(
-                                "Update test directory: "
-                                f"{td_data['config_source']}"
-                            ),
+                            panel_version=panel_version,
+                            description=panel_feature_description,
                             panel=panel_obj, feature=feature_obj
                         )
 
-                    # extract date of the source for the clinical indication
-                    # versions
-                    td_date, td_type = td_data["config_source"].split("_")
-                    td_date_str = datetime.datetime.strptime(
-                        td_date, "%y%m%d"
-                    ).strftime("%Y-%m-%d")
-
                     # create link between clinical indication and panel
                     cp_link = ClinicalIndicationPanels.objects.get_or_create(
-                        ci_version=f"TD_{td_date_str}",
+                        ci_version=ci_version,
                         panel=panel_obj,
                         clinical_indication=ci_obj
                     )
@@ -765,25 +860,54 @@ def check_if_ci_data_in_database(data: dict):
             ).distinct().values_list("id", flat=True)
 
             # gather provided genes
-            for panel in ci_data["panels"]:
-                panel_data = ci_data["panels"][panel]
-
-                for gene in panel_data["genes"]:
-                    # get the feature id for the genes
-                    feature_obj = Feature.objects.get(gene__hgnc_id=gene)
-                    features_from_form.add(feature_obj.id)
-
-            versions_of_panel = PanelFeatures.objects.filter(
-                panel_id__in=panel_ids
-            ).values_list("panel_version", flat=True)
-
-            for version in versions_of_panel:
-                features_from_database = set(
-                    PanelFeatures.objects.filter(
-                        panel_id__in=panel_ids, panel_version=version
-                    ).values_list("feature_id", flat=True)
+            form_genes = {
+                gene
+                for panel_data in ci_data["panels"].values()
+                for gene in panel_data["genes"]
+            }
+
+            # get the feature ids for the genes in one query (per chunk of
+            # genes) instead of one query per gene
+            gene2feature_ids = defaultdict(list)
+
+            for chunk in chunk_values(form_genes):
+                for hgnc_id, feature_id in Feature.objects.filter(
+                    gene__hgnc_id__in=chunk
+                ).values_list("gene__hgnc_id", "id"):
+                    gene2feature_ids[hgnc_id].append(feature_id)
+
+            missing_genes = sorted(form_genes - gene2feature_ids.keys())
+            genes_with_multiple_features = {
+                gene: feature_ids
+                for gene, feature_ids in gene2feature_ids.items()
+                if len(feature_ids) > 1
+            }
+
+            if missing_genes or genes_with_multiple_features:
+                raise Exception(
+                    "Couldn't get a single feature for the genes. Genes "
+                    f"without a feature: {missing_genes}. Genes with "
+                    f"multiple features: {genes_with_multiple_features}"
+                )
+
+            features_from_form.update(
+                feature_ids[0] for feature_ids in gene2feature_ids.values()
+            )
+
+            # get the features of every version of the panels in one query
+            # instead of one query per version
+            version2features = defaultdict(set)
+
+            # join through the clinical indication links rather than passing
+            # panel_ids, which django would send as an IN subquery
+            for version, feature_id in PanelFeatures.objects.filter(
+                panel__clinicalindicationpanels__clinical_indication_id=(
+                    ci_obj_id
                 )
+            ).values_list("panel_version", "feature_id"):
+                version2features[version].add(feature_id)
 
+            for version, features_from_database in version2features.items():
                 # compare features gathered
                 if features_from_database == features_from_form:
                     return True, (
@@ -796,30 +920,26 @@ def check_if_ci_data_in_database(data: dict):
 
 
 def gather_ci_and_panels_to_keep(ci_to_keep):
-    data = []
-
-    # gathering bespoke panels to keep
-    bespoke_cis = ClinicalIndication.objects.filter(code__iregex=r"^C")
+    # gathering bespoke clinical indications to keep
+    cis = list(ClinicalIndication.objects.filter(code__iregex=r"^C"))
 
-    # get panels associated
-    for bespoke_ci in bespoke_cis:
-        bespoke_panels = Panel.objects.filter(
-            clinicalindicationpanels__clinical_indication=bespoke_ci
-        )
+    # gather ci provided
+    for ci in ci_to_keep:
+        cis.append(ClinicalIndication.objects.get(code=ci))
 
-        data.append([bespoke_ci, bespoke_panels])
+    # get the panels of all those clinical indications in one query instead
+    # of one query per clinical indication
+    ci_panel_links = ClinicalIndicationPanels.objects.filter(
+        clinical_indication__in=cis
+    ).select_related("panel")
 
-    # gather ci provided and associated panels
-    for ci in ci_to_keep:
-        clinical_indication = ClinicalIndication.objects.get(
-            code=ci
-        )
+    # use dicts keyed on the panel id to only keep distinct panels
+    panels_per_ci = defaultdict(dict)
 
-        panels = Panel.objects.filter(
-            clinicalindicationpanels__clinical_indication=clinical_indication
-        ).distinct()
+    for link in ci_panel_links:
+        panels_per_ci[link.clinical_indication_id][link.panel_id] = link.panel
 
-        data.append([clinical_indication, panels])
+    data = [[ci, list(panels_per_ci[ci.id].values())] for ci in cis]
 
     return data
 
@@ -0,0 +1,61 @@
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from ops.logger import output_to_loggers
+
+
+@contextmanager
+def count_queries(session):
+    """ Record the SQL statements sent to the database while in the context
+
+    Args:
+        session (SQLAlchemy session obj): SQLAlchemy session
+
+    Yields:
+        list: List of the statements executed, filled as they are executed
+    """
+
+    statements = []
+    engine = session.get_bind()
+
+    def record_statement(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record_statement)
+
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record_statement)
+
+
+def assert_query_count(statements: list, max_queries: int, *loggers):
+    """ Check that the number of statements executed is under a given bound
+
+    Args:
+        statements (list): List of statements recorded by count_queries
+        max_queries (int): Maximum number of statements allowed
+        loggers (logger): Loggers to report the statements executed to
+
+    Raises:
+        AssertionError: If more statements than allowed were executed
+    """
+
+    if len(statements) > max_queries:
+        msg = (
+            f"{len(statements)} queries executed, expected {max_queries} at "
+            "most"
+        )
+        # output the statements by number of executions to pinpoint the loop
+        # sending the queries
+        statement_counts = "\n".join(
+            f"{count}\t{statement}"
+            for statement, count in Counter(statements).most_common()
+        )
+        output_to_loggers(f"{msg}\n{statement_counts}", "error", *loggers)
+
+        raise AssertionError(msg)
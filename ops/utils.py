@@ -8,7 +8,7 @@ from pathlib import Path
 from packaging import version
 import pandas as pd
 import regex
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql.schema import MetaData
 import xlrd
@@ -22,6 +22,9 @@ from ops.logger import setup_logging, output_to_loggers
 
 CONSOLE, UTILS = setup_logging("utils")
 
+# TRAC and IGHM genes are removed from genepanels and manifest
+EXCLUDED_HGNC_IDS = frozenset(["HGNC:12029", "HGNC:5541"])
+
 
 def get_date():
     """ Return today's date in YYMMDD format
@@ -442,7 +445,8 @@ def clean_targets(clinind_data: dict):
 
     clean_clinind_data = defaultdict(lambda: defaultdict(list))
 
-    ci_to_remove = []
+    # set so that the membership checks and removals don't scan a list
+    ci_to_remove = set()
 
     for test_code in clinind_data:
         data = clinind_data[test_code]
@@ -480,7 +484,7 @@ def clean_targets(clinind_data: dict):
                 # Panels can have "As dictated by blabla" "As indicated by"
                 # so I remove those
                 if indiv_target.startswith("As "):
-                    ci_to_remove.append(test_code)
+                    ci_to_remove.add(test_code)
                     output_to_loggers(removed_msg, "info", CONSOLE, UTILS)
 
                 # check if the target has parentheses with numbers in there
@@ -506,17 +510,16 @@ def clean_targets(clinind_data: dict):
                     else:
                         # only case where this happens is a
                         # As dictated by clinical indication case
-                        ci_to_remove.append(test_code)
+                        ci_to_remove.add(test_code)
                         output_to_loggers(removed_msg, "info", CONSOLE, UTILS)
             else:
-                ci_to_remove.append(test_code)
+                ci_to_remove.add(test_code)
                 output_to_loggers(removed_msg, "info", CONSOLE, UTILS)
 
         # handle the hard coded tests
         if test_code in hd_tests:
             # remove test_code from the clinical indication to remove list
-            if test_code in ci_to_remove:
-                ci_to_remove.remove(test_code)
+            ci_to_remove.discard(test_code)
 
             msg = f"{test_code} is added as a hardcoded test"
             output_to_loggers(msg, "info", CONSOLE, UTILS)
@@ -656,13 +659,33 @@ def gather_feature_types_django_json(feature_types: list, pk: int):
     return featuretype_json
 
 
+def index_objects(list_existing_objects: list, field_to_query: str):
+    """ Index json objects using the value of the given field, so that objects
+    can be looked up without going through the whole list every time
+
+    Args:
+        list_existing_objects (list): List of json objects
+        field_to_query (str): Field to index the objects with
+
+    Returns:
+        dict: Dict of field value to the list of json objects with that value
+    """
+
+    object_index = defaultdict(list)
+
+    for obj in list_existing_objects:
+        object_index[obj["fields"][field_to_query]].append(obj)
+
+    return object_index
+
+
 def get_existing_object_pk(
-    list_existing_objects: list, field_to_query: str, value: str
+    object_index: dict, field_to_query: str, value: str
 ):
     """ Get the primary key of an object obtained using given field and value
 
     Args:
-        list_existing_objects (list): List of json objects
+        object_index (dict): Json objects indexed on the field to query
         field_to_query (str): Field to query
         value (str): Value for given field
 
@@ -675,11 +698,7 @@ def get_existing_object_pk(
         str: Primary key of object
     """
 
-    object_to_return = [
-        obj["pk"]
-        for obj in list_existing_objects
-        if obj["fields"][field_to_query] == value
-    ]
+    object_to_return = [obj["pk"] for obj in object_index.get(value, [])]
 
     if object_to_return != [] and len(object_to_return) == 1:
         return object_to_return[0]
@@ -709,11 +728,11 @@ def get_existing_object_pk(
         raise Exception(msg)
 
 
-def get_links(list_existing_links: list, field_to_query: str, value: str):
+def get_links(link_index: dict, field_to_query: str, value: str):
     """ Return the link object between 2 tables
 
     Args:
-        list_existing_links (list): List of json of the links
+        link_index (dict): Json of the links indexed on the field to query
         field_to_query (str): Field to query in the json
         value (str): Value of the field to query
 
@@ -725,11 +744,7 @@ def get_links(list_existing_links: list, field_to_query: str, value: str):
         list: List of json matching the query
     """
 
-    objects_to_return = [
-        obj
-        for obj in list_existing_links
-        if obj["fields"][field_to_query] == value
-    ]
+    objects_to_return = link_index.get(value, [])
 
     if objects_to_return != []:
         return objects_to_return
@@ -775,12 +790,22 @@ def gather_panel_data_django_json(
 
     gene_json = []
 
+    # index the types once instead of going through their lists for every
+    # panel and gene
+    paneltype_index = index_objects(paneltype_json, "type")
+    # Get the primary key of the gene feature type
+    gene_feature_pk = get_existing_object_pk(
+        index_objects(featuretype_json, "type"), "type", "gene"
+    )
+    # primary keys of the gene and feature created for every gene
+    gene2pks = {}
+
     # Create the list for panel, panel_gene, gene
     for panel_pk, panelapp_id in enumerate(panelapp_dict, pk_dict["panel"]+1):
         panel_dict = panelapp_dict[panelapp_id]
         # Get the primary key of the appropriate panel type
         panel_type_pk = get_existing_object_pk(
-            paneltype_json, "type", panel_dict["type"]
+            paneltype_index, "type", panel_dict["type"]
         )
 
         if panelapp_id.endswith("_SG"):
@@ -796,10 +821,6 @@ def gather_panel_data_django_json(
         # go through the genes of the panel
         for hgnc_id in panel_dict["genes"]:
             gene_data = gene_dict[hgnc_id]
-            # Get the primary key of the gene feature type
-            gene_feature_pk = get_existing_object_pk(
-                featuretype_json, "type", "gene"
-            )
 
             # we haven't encountered this gene and added it to the json list
             # so we go ahead and create it
@@ -826,15 +847,11 @@ def gather_panel_data_django_json(
                         gene_id=gene_pk
                     )
                 )
+                gene2pks[hgnc_id] = (gene_pk, feature_pk)
             else:
                 # we have seen the gene so we get references to the gene obj
                 # and the feature obj
-                gene_pk = get_existing_object_pk(
-                    gene_json, "hgnc_id", hgnc_id
-                )
-                feature_pk = get_existing_object_pk(
-                    feature_json, "gene_id", int(gene_pk)
-                )
+                gene_pk, feature_pk = gene2pks[hgnc_id]
 
             # Create panel_feature link
             pk_dict["panel_feature"] += 1
@@ -872,6 +889,22 @@ def gather_superpanel_data_django_json(
                 modified panel features list
     """
 
+    # normalise the existing links once to check for duplicates without
+    # going through the whole panel features list for every feature
+    existing_links = {
+        (
+            int(obj["fields"]["panel_id"]), int(obj["fields"]["feature_id"]),
+            str(obj["fields"]["panel_version"])
+        )
+        for obj in panelfeature_json
+    }
+
+    # index the panels and their links once instead of going through the
+    # lists for every subpanel, kept up to date as superpanels are added
+    paneltype_index = index_objects(paneltype_json, "type")
+    panel_index = index_objects(panel_json, "panelapp_id")
+    panelfeature_index = index_objects(panelfeature_json, "panel_id")
+
     # pk is the latest panel created + 1
     for superpanel_pk, superpanel_id in enumerate(
         superpanel_dict, pk_dict["panel"]+1
@@ -880,15 +913,15 @@ def gather_superpanel_data_django_json(
 
         # Get the primary key of the appropriate panel type
         panel_type_pk = get_existing_object_pk(
-            paneltype_json, "type", superpanel_data["type"]
+            paneltype_index, "type", superpanel_data["type"]
         )
         panel_fields = {
                 "panelapp_id": superpanel_id, "name": superpanel_data["name"],
                 "panel_type_id": panel_type_pk
         }
-        panel_json.append(
-            get_django_json("Panel", superpanel_pk, panel_fields)
-        )
+        superpanel_obj = get_django_json("Panel", superpanel_pk, panel_fields)
+        panel_json.append(superpanel_obj)
+        panel_index[superpanel_id].append(superpanel_obj)
 
         # go through superpanel subpanels
         # the idea is to bypass subpanels when creating the panel2features
@@ -898,13 +931,13 @@ def gather_superpanel_data_django_json(
 
             # get the primary key of the subpanel
             subpanel_pk = get_existing_object_pk(
-                panel_json, "panelapp_id", subpanel_id
+                panel_index, "panelapp_id", subpanel_id
             )
 
             # Use the already existing links from normal panels
             # to create the superpanel links to the features
             panel2features = get_links(
-                panelfeature_json, "panel_id", int(subpanel_pk)
+                panelfeature_index, "panel_id", int(subpanel_pk)
             )
 
             # go through the panel2features object of the specific subpanel
@@ -912,27 +945,25 @@ def gather_superpanel_data_django_json(
                 # get the pk of the feature
                 feature_pk = panel_feature["fields"]["feature_id"]
 
+                link = (
+                    int(superpanel_pk), int(feature_pk),
+                    str(superpanel_data["version"])
+                )
+
                 # check if the link already exists i.e. superpanel has
                 # subpanels that link to the same gene
-                already_existing_link = [
-                    obj
-                    for obj in panelfeature_json
-                    if int(obj["fields"]["panel_id"]) == int(superpanel_pk) and
-                    int(obj["fields"]["feature_id"]) == int(feature_pk) and
-                    str(obj["fields"]["panel_version"]) == str(
-                        superpanel_data["version"]
-                    )
-                ]
-
                 # if that link doesn't exist need to create it
-                if already_existing_link == []:
+                if link not in existing_links:
+                    existing_links.add(link)
                     pk_dict["panel_feature"] += 1
-                    panelfeature_json.append(
-                        add_panel_feature(
-                            pk_dict["panel_feature"], superpanel_pk,
-                            superpanel_data["version"], feature_pk
-                        )
+                    superpanel_feature = add_panel_feature(
+                        pk_dict["panel_feature"], superpanel_pk,
+                        superpanel_data["version"], feature_pk
                     )
+                    panelfeature_json.append(superpanel_feature)
+                    panelfeature_index[
+                        superpanel_feature["fields"]["panel_id"]
+                    ].append(superpanel_feature)
 
     return panel_json, panelfeature_json
 
@@ -962,6 +993,11 @@ def gather_clinical_indication_data_django_json(
     clinical_indication_json = []
     clinical_indication2panels_json = []
 
+    # index the panels once instead of going through the list for every
+    # clinical indication panel
+    panel_id_index = index_objects(panel_json, "panelapp_id")
+    panel_name_index = index_objects(panel_json, "name")
+
     # go through the test codes
     for clin_ind_pk, test_code in enumerate(
         clin_ind2targets, pk_dict["clinind"]+1
@@ -1038,13 +1074,13 @@ def gather_clinical_indication_data_django_json(
             if regex.match(r"[0-9*]", panel):
                 # it's a panelapp id
                 panel_pk = get_existing_object_pk(
-                    panel_json, "panelapp_id", panel
+                    panel_id_index, "panelapp_id", panel
                 )
             else:
                 # it's a gene panel name thingy (HGNC:[0-9]_SG)
                 gene_panel_name = f"{panel}_SG_panel"
                 panel_pk = get_existing_object_pk(
-                    panel_json, "name", gene_panel_name
+                    panel_name_index, "name", gene_panel_name
                 )
 
             pk_dict["clinind_panels"] += 1
@@ -1081,6 +1117,11 @@ def gather_transcripts(
     genes2transcripts_json = []
 
     date = str(datetime.date.today())
+    # the transcripts are all linked to GRCh37, get its pk once for all of
+    # them
+    ref_pk = get_existing_object_pk(
+        index_objects(reference_json, "name"), "name", "GRCh37"
+    )
 
     gene_objs = [obj for obj in gene_json]
 
@@ -1108,11 +1149,6 @@ def gather_transcripts(
             )
 
             gene_pk = gene_obj["pk"]
-            ref_pk = [
-                obj["pk"]
-                for obj in reference_json
-                if obj["fields"]["name"] == "GRCh37"
-            ][0]
 
             pk_dict["g2t"] += 1
             # create the g2t obj
@@ -1187,17 +1223,19 @@ def gather_single_genes(clin_ind2targets: dict):
         clin_ind2targets (dict): Dict of clinical indications
 
     Returns:
-        list: List of single genes used in clinical indications
+        list: List of unique single genes used in clinical indications
     """
 
-    single_genes = []
+    # genes shared by several clinical indications are only kept once, using
+    # a dict to keep the order in which they were found
+    single_genes = {}
 
     for test_code in clin_ind2targets:
         if "genes" in clin_ind2targets[test_code]:
             genes = clin_ind2targets[test_code]["genes"]
-            single_genes += genes
+            single_genes.update(dict.fromkeys(genes))
 
-    return single_genes
+    return list(single_genes)
 
 
 def get_clinical_indication_through_genes(
@@ -1223,24 +1261,50 @@ def get_clinical_indication_through_genes(
 
     gemini2genes = defaultdict(lambda: defaultdict(lambda: set()))
 
+    panel_ids = {
+        panel_id
+        for panels in clinical_indications.values()
+        for panel_id, ci_version in panels
+    }
+    panel2data = defaultdict(list)
+
+    # get all genes of all the panels in one query (per chunk of panels)
+    # instead of one query per panel and clinical indication. The query is
+    # built once with a bound IN list and only the values change per chunk
+    panel_genes_query = session.query(
+        panel2features_tb.c.panel_id, panel_tb.c.name,
+        panel2features_tb.c.feature_id, panel2features_tb.c.panel_version,
+        gene_tb.c.hgnc_id, panel_tb.c.panelapp_id
+    ).select_from(panel_tb).join(panel2features_tb).join(
+        feature_tb
+    ).join(gene_tb).filter(
+        panel2features_tb.c.panel_id.in_(
+            bindparam("panel_ids", expanding=True)
+        )
+    )
+
+    # the rows are streamed as they are only used to fill panel2data
+    for chunk in chunk_values(panel_ids):
+        for panel_id, *row in panel_genes_query.params(
+            panel_ids=chunk
+        ).yield_per(1000):
+            panel2data[panel_id].append(row)
+
     for ci, panels in clinical_indications.items():
         for panel_id, ci_version in panels:
-            # query to get all genes from a panel id
-            data = session.query(
-                panel_tb.c.name, panel2features_tb.c.feature_id,
-                panel2features_tb.c.panel_version, gene_tb.c.hgnc_id,
-                panel_tb.c.panelapp_id
-            ).join(panel2features_tb).join(feature_tb).join(gene_tb).filter(
-                panel2features_tb.c.panel_id == panel_id
-            ).all()
+            # all genes from a panel id
+            data = panel2data[panel_id]
 
             # use the packaging package to parse the version and take the latest
             # version
-            latest_version = get_latest_panel_version([d[2] for d in data])
-            panel_genes = [(d[0], d[2], d[3], d[4]) for d in data]
+            latest_version = get_latest_panel_version(
+                panel_version for _, _, panel_version, _, _ in data
+            )
             hgnc_ids = []
 
-            for panel, panel_version, hgnc_id, panelapp_id in panel_genes:
+            # unpack the rows directly rather than copying them for every
+            # clinical indication linked to the panel
+            for panel, _, panel_version, hgnc_id, panelapp_id in data:
                 ci_info = f"{ci}:{panelapp_id}"
                 if "|" in panel_version:
                     formatted_version = panel_version.split("|")
@@ -1260,7 +1324,7 @@ def get_clinical_indication_through_genes(
                         continue
 
                     # remove TRAC and IGHM genes from genepanels and manifest
-                    if hgnc_id in ["HGNC:12029", "HGNC:5541"]:
+                    if hgnc_id in EXCLUDED_HGNC_IDS:
                         continue
 
                     hgnc_ids.append(hgnc_id)
@@ -1340,6 +1404,9 @@ def get_latest_clinical_indication_data(query_result):
     """
 
     ci2panels = {}
+    # parsed date of the links stored for every clinical indication so that
+    # the stored version doesn't need to be parsed again for every row
+    ci2date = {}
 
     # get latest version of clinical indication
     for ci in query_result:
@@ -1349,14 +1416,13 @@ def get_latest_clinical_indication_data(query_result):
 
         # compare dates between stored date and new date
         if gemini_name in ci2panels:
-            # all dates stored should have the same date so select first
-            # element of list of tuples and get the date of the ci2panel link
-            stored_source, stored_version = ci2panels[gemini_name][0][1].split("_")
-            dated_stored_version = datetime.date.fromisoformat(stored_version)
+            # all dates stored should have the same date
+            dated_stored_version = ci2date[gemini_name]
 
             # if new date is higher replace all stored dates
             if dated_version > dated_stored_version:
                 ci2panels[gemini_name] = [(panel_id, ci_version)]
+                ci2date[gemini_name] = dated_version
             # date identical we need to store the incoming date and panel id
             elif dated_version == dated_stored_version:
                 ci2panels[gemini_name].append((panel_id, ci_version))
@@ -1364,6 +1430,7 @@ def get_latest_clinical_indication_data(query_result):
         # unseen clinical indication
         else:
             ci2panels[gemini_name] = [(panel_id, ci_version)]
+            ci2date[gemini_name] = dated_version
 
     return ci2panels
 
@@ -1481,15 +1548,31 @@ def get_reference_id(session, meta, reference: str):
     """
     ref_tb = meta.tables["reference"]
 
-    ref_query = session.query(
+    # scalar raises if more than one row is returned
+    ref_id = session.query(
         ref_tb.c.id
     ).filter(
         ref_tb.c.name == reference
-    ).one()
+    ).scalar()
 
-    assert len(ref_query) == 1, (
-        "The reference query didn't return only one row:\n"
-        f"{','.join([query for query in ref_query])}"
-    )
+    if ref_id is None:
+        raise Exception(f"Reference {reference} is not in the database")
+
+    return ref_id
+
+
+def chunk_values(values, chunk_size: int = 500):
+    """ Split values in lists of a given size i.e. to keep IN clauses short
+
+    Args:
+        values (iterable): Values to split
+        chunk_size (int, optional): Size of the chunks. Defaults to 500.
+
+    Yields:
+        list: Chunk of values
+    """
+
+    values = list(values)
 
-    return ref_query[0]
+    for i in range(0, len(values), chunk_size):
+        yield values[i:i + chunk_size]